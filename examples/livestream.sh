@@ -8,14 +8,26 @@
 set -eo pipefail
 
 url="http://a.files.bbci.co.uk/media/live/manifesto/audio/simulcast/hls/nonuk/sbr_low/ak/bbc_world_service.m3u8"
-fmt=aac # the audio format extension of the stream (TODO: auto detect)
 step_s=30
 model="base.en"
+port=8178 # local port of the whisper-server that keeps the model loaded, must be free
+server=./build/bin/whisper-server
+
+# use the CPUs actually available to us (nproc honors the affinity mask), whisper gains little beyond 16
+threads=$(nproc 2>/dev/null || sysctl -n hw.ncpu 2>/dev/null || echo 4)
+if [ $threads -gt 16 ]; then
+    threads=16
+fi
 
 check_requirements()
 {
-    if ! command -v ./build/bin/whisper-cli &>/dev/null; then
-        echo "whisper.cpp main executable is required (make)"
+    if ! command -v $server &>/dev/null; then
+        echo "whisper.cpp server executable is required (make)"
+        exit 1
+    fi
+
+    if ! command -v curl &>/dev/null; then
+        echo "curl is required (https://curl.se)"
         exit 1
     fi
 
@@ -23,16 +35,27 @@ check_requirements()
         echo "ffmpeg is required (https://ffmpeg.org)"
         exit 1
     fi
+
+    # steps are cut off the stream with head -c, which must not read past the requested bytes.
+    # GNU head reads exactly that much, BSD head (macOS) reads through stdio and may swallow more
+    if head --version 2>/dev/null | grep -q GNU; then
+        head_cmd=head
+    elif command -v ghead &>/dev/null; then
+        head_cmd=ghead
+    else
+        echo "GNU head is required (on macOS: brew install coreutils)"
+        exit 1
+    fi
 }
 
 check_requirements
 
 
 if [ -z "$1" ]; then
-    echo "Usage: $0 stream_url [step_s] [model]"
+    echo "Usage: $0 stream_url [step_s] [model] [port]"
     echo ""
     echo "  Example:"
-    echo "    $0 $url $step_s $model"
+    echo "    $0 $url $step_s $model $port"
     echo ""
     echo "No url specified, using default: $url"
 else
@@ -47,6 +70,10 @@ if [ -n "$3" ]; then
     model="$3"
 fi
 
+if [ -n "$4" ]; then
+    port="$4"
+fi
+
 # Whisper models
 models=( "tiny.en" "tiny" "base.en" "base" "small.en" "small" "medium.en" "medium" "large-v1" "large-v2" "large-v3" "large-v3-turbo" )
 
@@ -67,46 +94,179 @@ if [[ ! " ${models[@]} " =~ " ${model} " ]]; then
     exit 1
 fi
 
+model_path=./models/ggml-${model}.bin
+if [ ! -f $model_path ]; then
+    printf "Model file not found: $model_path\n\nDownload a model with this command:\n\n> bash ./models/download-ggml-model.sh $model\n\n"
+    exit 1
+fi
+
+server_url=http://127.0.0.1:$port
+
 running=1
 
 trap "running=0" SIGINT SIGTERM
 
 printf "[+] Transcribing stream with model '$model', step_s $step_s (press Ctrl+C to stop):\n\n"
 
-# continuous stream in native fmt (this file will grow forever!)
-ffmpeg -loglevel quiet -y -re -probesize 32 -i $url -c copy /tmp/whisper-live0.${fmt} &
-if [ $? -ne 0 ]; then
-    printf "Error: ffmpeg failed to capture audio stream\n"
+# stop one of our background processes, killing it if it does not exit within a second
+stop()
+{
+    kill $1 2>/dev/null
+    for _ in 1 2 3 4 5 6 7 8 9 10; do
+        if ! kill -0 $1 2>/dev/null; then
+            return 0
+        fi
+        sleep 0.1
+    done
+    kill -9 $1 2>/dev/null
+}
+
+server_pid=
+ffmpeg_pid=
+server_log=
+keep_server_log=0
+step_dir=
+
+# stop whatever this run has started and remove its files, on every exit path
+cleanup()
+{
+    # the trap can fire while set -e is still on, a failing step must not cut the cleanup short
+    set +e
+
+    if [ -n "$ffmpeg_pid" ]; then
+        stop $ffmpeg_pid
+    fi
+    if [ -n "$server_pid" ]; then
+        stop $server_pid
+    fi
+    if [ -n "$server_log" ] && [ $keep_server_log -eq 0 ]; then
+        rm -f $server_log
+    fi
+    if [ -n "$step_dir" ]; then
+        rm -rf $step_dir
+    fi
+}
+
+trap cleanup EXIT
+
+# per-run log file, so that several instances of this script do not clobber each other's logs.
+# it is removed on exit, unless the server fails to start
+server_log=$(mktemp /tmp/whisper-server.XXXXXX)
+
+# our server would fail to bind, give a clearer error up front if something already listens on the port
+if curl -s -o /dev/null $server_url/; then
+    printf "Error: port $port is already in use, pass a free one as the 4th argument\n"
     exit 1
 fi
 
+# load the model once and keep it resident for the whole stream, instead of reloading it for every step
+$server -t $threads -m $model_path --host 127.0.0.1 --port $port -nt &> $server_log &
+server_pid=$!
+
+printf "Loading model. Please wait...\n\n"
+# the server binds its port only after loading the model, and announces it in its log once the bind succeeded.
+# probing the port instead could not tell our server from another process that took the port in the meantime
+until grep -q "whisper server listening at" $server_log; do
+    if ! kill -0 $server_pid 2>/dev/null; then
+        printf "Error: whisper-server failed to start, see $server_log\n"
+        keep_server_log=1
+        exit 1
+    fi
+    if [ $running -eq 0 ]; then
+        exit 0
+    fi
+    # Ctrl+C kills the sleep too - do not let set -e exit before $running is checked
+    sleep 1 || true
+done
+
+# continuous stream decoded to 16 kHz mono s16le PCM, read back below in fixed-size steps
+bytes_per_step=$((16000*2*$step_s))
+
+le16() { printf '\\x%02x\\x%02x' $(($1 & 0xff)) $((($1 >> 8) & 0xff)); }
+le32() { printf '\\x%02x\\x%02x\\x%02x\\x%02x' $(($1 & 0xff)) $((($1 >> 8) & 0xff)) $((($1 >> 16) & 0xff)) $((($1 >> 24) & 0xff)); }
+
+# every step has the same format and length, so its 44-byte wav header is constant (as printf escapes)
+wav_header="RIFF$(le32 $((36 + $bytes_per_step)))WAVEfmt $(le32 16)$(le16 1)$(le16 1)$(le32 16000)$(le32 32000)$(le16 2)$(le16 16)data$(le32 $bytes_per_step)"
+
+exec 3< <(ffmpeg -loglevel quiet -re -probesize 32 -i $url -ar 16000 -ac 1 -f s16le -)
+ffmpeg_pid=$!
+
 printf "Buffering audio. Please wait...\n\n"
-sleep $(($step_s))
+
+# transcribe a wav from stdin with the running whisper-server and print the text on a single line
+transcribe()
+{
+    local text
+    text=$(curl -sf -F "file=@-;filename=step.wav" -F response_format=text $server_url/inference)
+
+    # the server reports errors as json, e.g. for an empty step whose header does not match its length
+    case "$text" in
+        ""|"{\"error\""*)
+            return
+            ;;
+    esac
+
+    printf "%s\n" "${text//$'\n'/}"
+}
+
+# each step is handed to its background transcription through a fifo of its own
+step_dir=$(mktemp -d /tmp/whisper-live.XXXXXX)
 
 # do not stop script on error
 set +e
 
 i=0
-SECONDS=0
+pid_prev=
 while [ $running -eq 1 ]; do
-    # extract the next piece from the main file above and transcode to wav. -ss sets start time and nudges it by -0.5s to catch missing words (??)
-    err=1
-    while [ $err -ne 0 ]; do
-        if [ $i -gt 0 ]; then
-            ffmpeg -loglevel quiet -v error -noaccurate_seek -i /tmp/whisper-live0.${fmt} -y -ar 16000 -ac 1 -c:a pcm_s16le -ss $(($i*$step_s-1)).5 -t $step_s /tmp/whisper-live.wav 2> /tmp/whisper-live.err
-        else
-            ffmpeg -loglevel quiet -v error -noaccurate_seek -i /tmp/whisper-live0.${fmt} -y -ar 16000 -ac 1 -c:a pcm_s16le -ss $(($i*$step_s)) -t $step_s /tmp/whisper-live.wav 2> /tmp/whisper-live.err
-        fi
-        err=$(cat /tmp/whisper-live.err | wc -l)
-    done
+    # hand the next step_s of PCM from the stream to a background transcription. once the step is
+    # handed over, whisper-server keeps transcribing it while the next step is being buffered
+    step_fifo=$step_dir/step$i
+    mkfifo $step_fifo
+    transcribe < $step_fifo &
+    pid=$!
+    exec 4> $step_fifo
+    rm -f $step_fifo
+    printf "%b" "$wav_header" >&4
+    n=$($head_cmd -c $bytes_per_step <&3 | tee /dev/fd/4 | wc -c)
 
-    ./build/bin/whisper-cli -t 8 -m ./models/ggml-${model}.bin -f /tmp/whisper-live.wav --no-timestamps -otxt 2> /tmp/whispererr | tail -n 1
+    # the last step of a stream comes up short - pad it with silence to the length promised by the
+    # wav header, so that the tail of the stream is transcribed too
+    if [ $running -eq 1 ] && [ "$n" -gt 0 ] && [ "$n" -lt $bytes_per_step ]; then
+        head -c $(($bytes_per_step - $n)) /dev/zero >&4
+    fi
+    exec 4>&-
 
-    while [ $SECONDS -lt $((($i+1)*$step_s)) ]; do
-        sleep 1
-    done
+    # the previous step had a full step_s to finish - wait for it so transcriptions do not pile up
+    if [ -n "$pid_prev" ]; then
+        wait $pid_prev
+    fi
+    pid_prev=$pid
+
+    # Ctrl+C kills the reader along with the step, so its byte count means nothing then
+    if [ $running -eq 0 ]; then
+        break
+    fi
+
+    # transcribe() drops failed requests, so a dead server would otherwise go unnoticed forever
+    if ! kill -0 $server_pid 2>/dev/null; then
+        printf "Error: whisper-server exited unexpectedly, see $server_log\n"
+        keep_server_log=1
+        exit 1
+    fi
+
+    # ffmpeg only comes up short when the stream is over
+    if [ "$n" -lt $bytes_per_step ]; then
+        if [ $i -eq 0 ] && [ "$n" -eq 0 ]; then
+            printf "Error: ffmpeg failed to capture audio stream\n"
+            exit 1
+        else
+            printf "Audio stream ended\n"
+        fi
+        break
+    fi
     ((i=i+1))
 done
 
-killall -v ffmpeg
-killall -v whisper-cli
+if [ -n "$pid_prev" ]; then
+    wait $pid_prev
+fi
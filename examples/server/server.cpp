@@ -1046,6 +1046,7 @@ int main(int argc, char ** argv) {
 
     // to make it ctrl+clickable:
     printf("\nwhisper server listening at http://%s:%d\n\n", sparams.hostname.c_str(), sparams.port);
+    fflush(stdout);
 
     if (!svr.listen_after_bind())
     {